@@ -13,7 +13,11 @@ fi
 
 # Install required packages
 echo "Installing required Python packages..."
-pip install openai
+pip install openai tiktoken
+
+# Optional extras: faster config parsing, retries, and the semantic cache
+pip install numpy orjson tenacity || \
+    echo "Warning: optional packages failed to install; continuing without them"
 
 # Create symlink in local bin directory
 TOOLS_DIR="$(pwd)"
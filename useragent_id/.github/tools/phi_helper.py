@@ -9,25 +9,87 @@ This tool helps with:
 4. Code suggestions
 
 Requirements:
-- openai package (pip install openai)
+- openai and tiktoken packages (pip install openai tiktoken)
 - A valid API key for OpenAI or Azure OpenAI with Phi-3 access
+
+Optional:
+- numpy (semantic response cache)
+- orjson (faster config parsing)
+- tenacity (retries on transient API errors)
 """
 
 import os
 import sys
 import argparse
+import ast
+import asyncio
+import atexit
+import fcntl
+import fnmatch
+import functools
+import hashlib
 import json
+import re
+import shelve
+import stat as stat_module
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 import subprocess
 from typing import Dict, List, Optional, Union, Any
 
 try:
     import openai
+    import httpx  # Ships with openai
 except ImportError:
     print("Error: openai package not installed. Run 'pip install openai'")
     sys.exit(1)
 
+try:
+    import tiktoken
+except ImportError:
+    print("Error: tiktoken package not installed. Run 'pip install tiktoken'")
+    sys.exit(1)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Semantic cache tier is disabled without numpy
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads  # stdlib json also accepts bytes
+
+try:
+    from tenacity import (retry, retry_if_exception_type, stop_after_attempt,
+                          wait_random_exponential)
+    # Absorb transient 429s/timeouts with jittered exponential backoff
+    # instead of failing the whole run and re-packing everything
+    _retry_transient = retry(
+        wait=wait_random_exponential(min=1, max=30),
+        stop=stop_after_attempt(6),
+        retry=retry_if_exception_type((
+            openai.RateLimitError,
+            openai.APITimeoutError,
+            openai.APIConnectionError,
+        )),
+        reraise=True,
+    )
+except ImportError:
+    def _retry_transient(func):
+        return func  # No retries without tenacity
+
 CONFIG_PATH = Path.home() / ".config" / "phi_helper" / "config.json"
+CACHE_DIR = Path.home() / ".cache" / "phi_helper"
+
+# Minimum cosine similarity for a semantic cache hit
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# Tokens reserved in every chunk for the repo map of overflow files
+REPO_MAP_TOKENS = 2000
 
 # Default configuration
 DEFAULT_CONFIG = {
@@ -35,12 +97,53 @@ DEFAULT_CONFIG = {
     "api_key": "",
     "azure_endpoint": "",  # Only needed for Azure
     "model": "phi-3",  # Default model
+    "router_model": "",  # Cheap model for simple queries (falls back to model)
+    "heavy_model": "",  # Large model for complex queries (falls back to model)
     "temperature": 0.3,
     "max_tokens": 4000,
+    "context_window": 128000,  # Model context size in tokens (set per model)
+    "max_concurrency": 8,  # Max in-flight API requests during the chunk fan-out
+    "max_chunks": 8,  # Max concurrent context windows; extra files get summarized
+    "embedding_model": "text-embedding-3-small",  # Used by the semantic cache
     "repository_path": "",
 }
 
 
+# Intents that warrant the heavy model: open-ended reasoning, design
+# discussion, or code rewriting
+COMPLEX_QUERY_KEYWORDS = {
+    "why", "design", "refactor", "architecture", "rewrite",
+    "improve", "optimize", "review", "tradeoff", "trade-offs",
+}
+
+
+def classify_query(query: str) -> str:
+    """Classify a query as 'cheap' or 'heavy' for model routing."""
+    words = query.lower().split()
+    if len(words) > 50:
+        return "heavy"
+    if any(word.strip("?,.!:;") in COMPLEX_QUERY_KEYWORDS for word in words):
+        return "heavy"
+    return "cheap"
+
+
+def route_config(config: Dict[str, Any], query: str) -> Dict[str, Any]:
+    """Pick the model for a query; simple queries go to the cheap model."""
+    if classify_query(query) == "cheap":
+        model = config.get("router_model") or config["model"]
+    else:
+        model = config.get("heavy_model") or config["model"]
+    return dict(config, model=model)
+
+
+def get_encoding(config: Dict[str, Any]):
+    """Get the tokenizer for the configured model, falling back to cl100k_base."""
+    try:
+        return tiktoken.encoding_for_model(config["model"])
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
 def ensure_config():
     """Ensure config directory and file exist."""
     config_dir = CONFIG_PATH.parent
@@ -57,37 +160,52 @@ def ensure_config():
     return load_config()
 
 
+@functools.lru_cache(maxsize=1)
 def load_config():
-    """Load configuration from file."""
-    with open(CONFIG_PATH, "r") as f:
-        config = json.load(f)
-    
+    """Load configuration from file, parsed once per process."""
+    config = _json_loads(CONFIG_PATH.read_bytes())
+
     # Validate required fields
     if config.get("api_key", "") == "":
         print(f"Error: API key not set in {CONFIG_PATH}")
         sys.exit(1)
-    
+
     return config
 
 
-def setup_client(config: Dict[str, Any]):
-    """Set up OpenAI or Azure client."""
-    if config["api_type"] == "azure":
-        if not config.get("azure_endpoint"):
-            print("Error: Azure endpoint not specified in config")
-            sys.exit(1)
-        
-        client = openai.AzureOpenAI(
-            api_key=config["api_key"],
-            azure_endpoint=config["azure_endpoint"],
-            api_version="2023-12-01-preview"
-        )
-    else:  # OpenAI
-        client = openai.OpenAI(
-            api_key=config["api_key"],
+def _http_client() -> "httpx.AsyncClient":
+    """Build a pooled HTTP client so the async fan-out reuses sockets."""
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    try:
+        return httpx.AsyncClient(http2=True, limits=limits)
+    except ImportError:  # http2 extra (h2) not installed
+        return httpx.AsyncClient(limits=limits)
+
+
+@functools.lru_cache(maxsize=4)
+def _client(api_type: str, api_key: str, azure_endpoint: str):
+    """Build (and cache) the API client for a given configuration."""
+    if api_type == "azure":
+        return openai.AsyncAzureOpenAI(
+            api_key=api_key,
+            azure_endpoint=azure_endpoint,
+            api_version="2023-12-01-preview",
+            http_client=_http_client(),
         )
-    
-    return client
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        http_client=_http_client(),
+    )
+
+
+def setup_client(config: Dict[str, Any]):
+    """Set up OpenAI or Azure client, reusing one per configuration."""
+    if config["api_type"] == "azure" and not config.get("azure_endpoint"):
+        print("Error: Azure endpoint not specified in config")
+        sys.exit(1)
+
+    return _client(config["api_type"], config["api_key"],
+                   config.get("azure_endpoint", ""))
 
 
 def git_get_repo_files(repo_path: str, exclude_patterns: List[str] = None) -> List[str]:
@@ -100,68 +218,199 @@ def git_get_repo_files(repo_path: str, exclude_patterns: List[str] = None) -> Li
             "traces/", "trained-agents/"
         ]
     
+    # Push the exclusions into git's pathspec matcher instead of
+    # filtering in Python: directory patterns become **/foo/** (matched
+    # at any depth) and extension patterns become **/*.ext
+    pathspecs = []
+    exclude_regexes = []
+    for pattern in exclude_patterns:
+        if pattern.endswith('/'):
+            pathspecs.append(f":(exclude,glob)**/{pattern}**")
+            exclude_regexes.append(fnmatch.translate(pattern + "*"))
+            exclude_regexes.append(fnmatch.translate("*/" + pattern + "*"))
+        elif pattern.startswith('*'):
+            pathspecs.append(f":(exclude,glob)**/{pattern}")
+            exclude_regexes.append(fnmatch.translate(pattern))
+        else:
+            pathspecs.append(f":(exclude,glob)**/{pattern}")
+            exclude_regexes.append(fnmatch.translate(pattern))
+            exclude_regexes.append(fnmatch.translate("*/" + pattern))
+
     try:
-        os.chdir(repo_path)
         result = subprocess.run(
-            ["git", "ls-files"], 
-            capture_output=True, 
-            text=True, 
+            ["git", "-C", repo_path, "ls-files", "-z", "--", "."] + pathspecs,
+            capture_output=True,
             check=True
         )
-        all_files = result.stdout.splitlines()
-        
-        # Filter out excluded patterns
-        filtered_files = []
-        for file in all_files:
-            if not any(pattern in file for pattern in exclude_patterns if pattern.endswith('/')):
-                if not any(file.endswith(pattern.strip('*')) for pattern in exclude_patterns if pattern.startswith('*')):
-                    filtered_files.append(file)
-        
-        return filtered_files
-    except subprocess.CalledProcessError as e:
-        print(f"Error running git ls-files: {e}")
-        return []
-
-
-def read_file_content(file_path: str, max_lines: Optional[int] = None) -> str:
+        # NUL-separated output is safe for filenames with newlines; git
+        # reports paths relative to repo_path, so anchor them there for
+        # callers whose cwd may be elsewhere
+        return [
+            os.path.normpath(os.path.join(
+                repo_path, f.decode("utf-8", errors="surrogateescape")))
+            for f in result.stdout.split(b"\0")[:-1]
+        ]
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        # Not a git repo (or no git): walk the tree, filtering with the
+        # patterns compiled into a single regex matched once per path
+        exclude_re = re.compile("|".join(exclude_regexes))
+        found = []
+        for root, dirs, names in os.walk(repo_path):
+            rel_root = os.path.relpath(root, repo_path)
+            if rel_root == ".":
+                rel_root = ""
+            # Prune excluded directories so we never descend into them
+            dirs[:] = [
+                d for d in dirs
+                if d != ".git" and not exclude_re.match(os.path.join(rel_root, d) + "/")
+            ]
+            for name in names:
+                rel_path = os.path.join(rel_root, name)
+                if not exclude_re.match(rel_path):
+                    found.append(os.path.normpath(os.path.join(repo_path, rel_path)))
+        return found
+
+
+# shelve handles are not thread-safe; the prefetch pool shares this lock
+_file_cache_lock = threading.Lock()
+_file_shelf = None
+_file_shelf_lock_file = None
+FILE_CACHE_PATH = CACHE_DIR / "files.shelve"
+
+
+def _file_shelf_handle():
+    """Open the on-disk file cache once per process (caller holds the lock)."""
+    global _file_shelf, _file_shelf_lock_file
+    if _file_shelf is None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        _file_shelf_lock_file = open(CACHE_DIR / "files.lock", "w")
+        _file_shelf = shelve.open(str(FILE_CACHE_PATH))
+        atexit.register(_file_shelf.close)
+    return _file_shelf
+
+
+def _file_cache_get(key: str) -> Optional[str]:
+    """Look up a file read in the on-disk cache shared across invocations."""
+    with _file_cache_lock:
+        try:
+            shelf = _file_shelf_handle()
+            fcntl.flock(_file_shelf_lock_file, fcntl.LOCK_SH)
+            try:
+                return shelf.get(key)
+            finally:
+                fcntl.flock(_file_shelf_lock_file, fcntl.LOCK_UN)
+        except Exception:
+            return None
+
+
+def _file_cache_put(key: str, content: str):
+    """Persist a file read for reuse by later invocations."""
+    with _file_cache_lock:
+        try:
+            shelf = _file_shelf_handle()
+            fcntl.flock(_file_shelf_lock_file, fcntl.LOCK_EX)
+            try:
+                shelf[key] = content
+            finally:
+                fcntl.flock(_file_shelf_lock_file, fcntl.LOCK_UN)
+        except Exception:
+            pass  # The cache is best-effort; a failed write just means a re-read
+
+
+def is_text_file(file_path: str) -> bool:
+    """Peek at the first 4 KiB to weed out binaries before tokenizing."""
+    try:
+        with open(file_path, 'rb') as f:
+            buf = f.read(4096)
+    except OSError:
+        return False
+    if not buf:
+        return True
+    if b'\x00' in buf:
+        return False
+    # Valid UTF-8 is text no matter how many high bytes it has (CJK
+    # documents are mostly multibyte); trim up to 3 trailing bytes in
+    # case the 4 KiB window split a character
+    for trim in range(4):
+        try:
+            buf[:len(buf) - trim].decode("utf-8")
+            return True
+        except UnicodeDecodeError:
+            continue
+    # Reject if control/high bytes dominate: binary read as UTF-8 either
+    # explodes or wastes tokens on garbage
+    suspicious = sum(b > 127 or b < 9 for b in buf)
+    return suspicious / len(buf) < 0.3
+
+
+def _read_file(file_path: str, max_lines: Optional[int] = None) -> str:
     """Read content from a file with optional line limit."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
+        with open(file_path, 'r', encoding='utf-8', buffering=1 << 20) as f:
             if max_lines:
-                return ''.join([next(f) for _ in range(max_lines)])
+                # islice stops cleanly at EOF, unlike next() in a comprehension
+                return ''.join(islice(f, max_lines))
             else:
                 return f.read()
     except Exception as e:
         return f"Error reading file {file_path}: {e}"
 
 
-def analyze_code(client, config: Dict[str, Any], files: List[str], query: str):
-    """Analyze code files based on query."""
-    file_contents = {}
-    total_chars = 0
-    char_limit = 100000  # Limit to ~100k characters to avoid token limits
-    
-    for file_path in files:
-        if total_chars > char_limit:
-            break
-            
-        if os.path.exists(file_path) and not os.path.isdir(file_path):
-            content = read_file_content(file_path)
-            file_size = len(content)
-            
-            if total_chars + file_size <= char_limit:
-                file_contents[file_path] = content
-                total_chars += file_size
-            else:
-                # Take as much as we can
-                remaining = char_limit - total_chars
-                if remaining > 1000:  # Only include if we can get a meaningful chunk
-                    truncated = read_file_content(file_path, remaining // 80)  # Estimate ~80 chars per line
-                    file_contents[file_path] = truncated + "\n... [truncated]"
-                    total_chars = char_limit
-    
-    # Prepare system message
-    system_message = f"""
+@functools.lru_cache(maxsize=8192)
+def read_file_content(file_path: str, mtime_ns: Optional[int] = None,
+                      size: Optional[int] = None,
+                      max_lines: Optional[int] = None) -> str:
+    """Read content from a file, memoized on (path, mtime, size).
+
+    Without the stat fields this is a plain read; with them, unchanged
+    files are served from memory or the on-disk cache instead of disk.
+    """
+    if mtime_ns is None:
+        return _read_file(file_path, max_lines)
+
+    key = f"{file_path}\0{mtime_ns}\0{size}\0{max_lines}"
+    cached = _file_cache_get(key)
+    if cached is not None:
+        return cached
+
+    content = _read_file(file_path, max_lines)
+    _file_cache_put(key, content)
+    return content
+
+
+# Languages with C-style comments that the compressor understands
+C_COMMENT_SUFFIXES = {".rs", ".js", ".ts", ".go", ".c", ".h", ".cpp", ".hpp", ".java"}
+HASH_COMMENT_SUFFIXES = {".sh", ".toml", ".yaml", ".yml"}
+
+
+def compress_source(file_path: str, content: str) -> str:
+    """Strip comments, docstrings and blank-line runs to cut prompt tokens."""
+    suffix = Path(file_path).suffix
+    if suffix == ".py":
+        try:
+            tree = ast.parse(content)
+            for node in ast.walk(tree):
+                if isinstance(node, (ast.Module, ast.ClassDef,
+                                     ast.FunctionDef, ast.AsyncFunctionDef)):
+                    body = node.body
+                    if (body and isinstance(body[0], ast.Expr)
+                            and isinstance(body[0].value, ast.Constant)
+                            and isinstance(body[0].value.value, str)):
+                        node.body = body[1:] or [ast.Pass()]
+            content = ast.unparse(tree)
+        except (SyntaxError, ValueError):
+            pass  # Keep the original if it does not parse
+    elif suffix in C_COMMENT_SUFFIXES:
+        content = re.sub(r"/\*.*?\*/", "", content, flags=re.DOTALL)
+        content = re.sub(r"(?m)^\s*//.*\n?", "", content)
+    elif suffix in HASH_COMMENT_SUFFIXES:
+        content = re.sub(r"(?m)^\s*#.*\n?", "", content)
+
+    # Collapse runs of blank lines regardless of language
+    return re.sub(r"\n\s*\n+", "\n\n", content)
+
+
+SYSTEM_MESSAGE = """
 You are Phi-3, a helpful AI coding assistant working with a Rust codebase for WasmAgentTrainer project.
 Analyze the provided code files and answer the query concisely and accurately.
 The project involves WebAssembly agent training and execution in a Rust environment.
@@ -170,37 +419,438 @@ When providing code examples, use idiomatic Rust when applicable.
 Keep explanations clear, focused, and technically precise.
 """
 
-    # Prepare user message
-    user_message = f"Query: {query}\n\nCode files:\n"
-    for file_path, content in file_contents.items():
-        user_message += f"\n--- {file_path} ---\n{content}\n"
-    
-    # Call OpenAI API
-    try:
-        if config["api_type"] == "azure":
-            response = client.chat.completions.create(
-                model=config["model"],
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=config["temperature"],
-                max_tokens=config["max_tokens"],
-            )
-        else:
-            response = client.chat.completions.create(
-                model=config["model"],
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=config["temperature"],
-                max_tokens=config["max_tokens"],
-            )
-        
+
+def score_file(file_path: str, size: int):
+    """Priority of a file for inclusion: shallow, large, non-test files first."""
+    return (-file_path.count('/'), size, 0 if 'test' in file_path.lower() else 1)
+
+
+def pack_chunks(config: Dict[str, Any], files: List[str], query: str,
+                compress: bool = False):
+    """Pack file contents into token-budgeted chunks, highest priority first.
+
+    Returns (chunks, leftovers): leftovers are files that did not fit within
+    max_chunks context windows and should only be summarized.
+    """
+    enc = get_encoding(config)
+    sys_tokens = len(enc.encode(SYSTEM_MESSAGE))
+    query_tokens = len(enc.encode(query))
+    # Reserve headroom for the repo map appended to every chunk when
+    # files overflow max_chunks; without it a full chunk plus the map
+    # would overshoot the context window
+    budget = (config.get("context_window", 128000) - config["max_tokens"]
+              - sys_tokens - query_tokens - REPO_MAP_TOKENS)
+    used_tokens = 0
+
+    def _fetch(file_path: str) -> Optional[str]:
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        if not stat_module.S_ISREG(st.st_mode):
+            return None
+        if not is_text_file(file_path):
+            return None
+        return read_file_content(file_path, st.st_mtime_ns, st.st_size)
+
+    # Prefetch file contents in parallel; the reads are I/O bound and
+    # per-file open/read latency dominates on large file lists
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        contents = dict(zip(files, executor.map(_fetch, files)))
+
+    if compress:
+        contents = {
+            path: compress_source(path, content) if content is not None else None
+            for path, content in contents.items()
+        }
+
+    # Rank files so the most structurally important land in the first
+    # chunks: shallow paths (main.rs, lib.rs) before deep ones, larger
+    # before smaller, tests last
+    ranked = sorted(
+        ((path, content) for path, content in contents.items() if content is not None),
+        key=lambda item: score_file(item[0], len(item[1])),
+        reverse=True,
+    )
+
+    # Split files into context-sized chunks; codebases larger than one
+    # context window become several concurrent API calls, capped at
+    # max_chunks with the remainder reduced to a repo map
+    max_chunks = config.get("max_chunks", 8)
+    chunks = []
+    leftovers = {}
+    current_chunk = {}
+    for file_path, content in ranked:
+        if len(chunks) >= max_chunks:
+            leftovers[file_path] = content
+            continue
+
+        header_tokens = len(enc.encode(f"\n--- {file_path} ---\n"))
+        toks = enc.encode(content)
+
+        if header_tokens + len(toks) > budget:
+            # File can never fit whole; give it a chunk of its own, truncated
+            if current_chunk:
+                chunks.append(current_chunk)
+                current_chunk = {}
+                used_tokens = 0
+            if len(chunks) >= max_chunks:
+                leftovers[file_path] = content
+                continue
+            remaining = budget - header_tokens
+            if remaining > 250:  # Only include if we can get a meaningful chunk
+                chunks.append({file_path: enc.decode(toks[:remaining]) + "\n... [truncated]"})
+            continue
+
+        if used_tokens + header_tokens + len(toks) > budget:
+            chunks.append(current_chunk)
+            current_chunk = {}
+            used_tokens = 0
+            if len(chunks) >= max_chunks:
+                leftovers[file_path] = content
+                continue
+
+        current_chunk[file_path] = content
+        used_tokens += header_tokens + len(toks)
+
+    if current_chunk and len(chunks) < max_chunks:
+        chunks.append(current_chunk)
+    elif current_chunk:
+        leftovers.update(current_chunk)
+
+    return chunks, leftovers
+
+
+def build_chunk_messages(config: Dict[str, Any], query: str,
+                         chunks: List[Dict[str, str]],
+                         repo_map: str = "") -> List[List[Dict[str, str]]]:
+    """Build the per-chunk chat messages for a query."""
+    chunk_messages = []
+    for i, file_contents in enumerate(chunks):
+        # Stable content (the file blob) goes first and the volatile query
+        # last, so provider-side prefix caching can reuse the file prefix
+        # across different queries over the same files
+        parts = [f"Code files (part {i + 1} of {len(chunks)}):\n"]
+        parts.extend(f"\n--- {file_path} ---\n{content}\n"
+                     for file_path, content in file_contents.items())
+        parts.append(repo_map)
+        parts.append(f"\nQuery: {query}\n")
+        chunk_messages.append([
+            {"role": "system", "content": SYSTEM_MESSAGE},
+            {"role": "user", "content": "".join(parts)}
+        ])
+    return chunk_messages
+
+
+@_retry_transient
+async def _create_completion(client, config: Dict[str, Any],
+                             messages: List[Dict[str, str]], **kwargs):
+    """Single funnel for chat completions, retried on transient API errors."""
+    # The client object already encapsulates Azure vs OpenAI differences
+    return await client.chat.completions.create(
+        model=config["model"],
+        messages=messages,
+        temperature=config["temperature"],
+        max_tokens=config["max_tokens"],
+        **kwargs,
+    )
+
+
+async def _one_call(client, config: Dict[str, Any], messages: List[Dict[str, str]],
+                    semaphore: asyncio.Semaphore) -> str:
+    """Issue a single non-streaming chat completion, bounded by the semaphore."""
+    async with semaphore:
+        response = await _create_completion(client, config, messages)
         return response.choices[0].message.content
+
+
+async def _stream_call(client, config: Dict[str, Any], messages: List[Dict[str, str]]) -> str:
+    """Issue a streaming chat completion, echoing tokens to stdout as they arrive."""
+    # Only the initial request is retried; once tokens have been echoed,
+    # a replay would duplicate output
+    response = await _create_completion(client, config, messages, stream=True)
+
+    # Print each chunk as it arrives, but also collect the full text
+    # so callers (e.g. docs --output) can still use the return value
+    buf = []
+    async for chunk in response:
+        if not chunk.choices:
+            continue
+        piece = chunk.choices[0].delta.content or ""
+        sys.stdout.write(piece)
+        sys.stdout.flush()
+        buf.append(piece)
+    sys.stdout.write("\n")
+
+    return "".join(buf)
+
+
+def _cache_hashes(config: Dict[str, Any], query: str, chunks: List[Dict[str, str]]):
+    """Hash the stable context (model + system + files) and the exact prompt."""
+    h = hashlib.sha256()
+    h.update(config["model"].encode("utf-8"))
+    h.update(SYSTEM_MESSAGE.encode("utf-8"))
+    for file_contents in chunks:
+        for file_path, content in file_contents.items():
+            h.update(file_path.encode("utf-8", errors="surrogateescape"))
+            h.update(content.encode("utf-8", errors="surrogateescape"))
+    context_hash = h.hexdigest()
+    h.update(query.encode("utf-8"))
+    return context_hash, h.hexdigest()
+
+
+def _cache_get(exact_hash: str) -> Optional[str]:
+    """Return the cached response for an exact prompt hash, if any."""
+    cache_file = CACHE_DIR / f"{exact_hash}.json"
+    if cache_file.exists():
+        try:
+            with open(cache_file, "r") as f:
+                return json.load(f)["response"]
+        except (json.JSONDecodeError, KeyError):
+            return None
+    return None
+
+
+def _load_semantic_index():
+    """Load the semantic index metadata and its embedding matrix, if coherent."""
+    index_file = CACHE_DIR / "semantic_index.json"
+    matrix_file = CACHE_DIR / "semantic_matrix.npy"
+    if not index_file.exists() or not matrix_file.exists():
+        return [], None
+    try:
+        with open(index_file, "r") as f:
+            index = json.load(f)
+        matrix = np.load(matrix_file)
+    except (json.JSONDecodeError, ValueError, OSError):
+        return [], None
+    if len(index) != matrix.shape[0]:
+        return [], None  # Stale or torn write; start over
+    return index, matrix
+
+
+def _cache_put(exact_hash: str, context_hash: str, query: str,
+               embedding: Optional[List[float]], response: str):
+    """Store a response under its exact hash and index it for semantic lookup."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(CACHE_DIR / f"{exact_hash}.json", "w") as f:
+        json.dump({"response": response}, f)
+
+    if embedding is not None:
+        index, matrix = _load_semantic_index()
+        # Rows are stored normalized so lookup is a bare matmul
+        vec = np.asarray(embedding, dtype=np.float32)
+        vec /= np.linalg.norm(vec) or 1.0
+        matrix = vec[None, :] if matrix is None else np.vstack([matrix, vec])
+        index.append({
+            "context": context_hash,
+            "query": query,
+            "response_hash": exact_hash,
+        })
+        np.save(CACHE_DIR / "semantic_matrix.npy", matrix)
+        with open(CACHE_DIR / "semantic_index.json", "w") as f:
+            json.dump(index, f)
+
+
+async def _embed_texts(client, config: Dict[str, Any],
+                       texts: List[str]) -> Optional[List[List[float]]]:
+    """Embed texts in one batched call; None if embeddings are unavailable."""
+    try:
+        response = await client.embeddings.create(
+            model=config.get("embedding_model", "text-embedding-3-small"),
+            input=texts,
+        )
+        # The API may return out of order; re-sort by input index
+        data = sorted(response.data, key=lambda d: d.index)
+        return [d.embedding for d in data]
+    except Exception:
+        return None
+
+
+def _semantic_lookup(context_hash: str, embedding: List[float]) -> Optional[str]:
+    """Find a cached response whose query is semantically close enough."""
+    index, matrix = _load_semantic_index()
+    if matrix is None:
+        return None
+
+    mask = np.array([e["context"] == context_hash for e in index])
+    if not mask.any():
+        return None
+
+    vec = np.asarray(embedding, dtype=np.float32)
+    vec /= np.linalg.norm(vec) or 1.0
+    # Rows are prenormalized, so one matmul yields all cosine scores
+    scores = matrix[mask] @ vec
+    best = int(scores.argmax())
+    if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+        candidates = [e for e, m in zip(index, mask) if m]
+        return _cache_get(candidates[best]["response_hash"])
+    return None
+
+
+async def _summarize_leftovers(client, config: Dict[str, Any],
+                               leftovers: Dict[str, str],
+                               semaphore: asyncio.Semaphore) -> str:
+    """Reduce overflow files to a one-line-per-file repo map via the cheap model."""
+    cheap_config = dict(config, model=config.get("router_model") or config["model"])
+    enc = get_encoding(cheap_config)
+
+    items = list(leftovers.items())
+    batch_messages = []
+    for i in range(0, len(items), 20):
+        parts = ["For each file below, give a one-line summary of its purpose, "
+                 "formatted as 'path: summary'.\n"]
+        # The head of a file is enough for a one-liner
+        parts.extend(
+            f"\n--- {file_path} ---\n{enc.decode(enc.encode(content)[:500])}\n"
+            for file_path, content in items[i:i + 20]
+        )
+        batch_messages.append([
+            {"role": "system", "content": SYSTEM_MESSAGE},
+            {"role": "user", "content": "".join(parts)}
+        ])
+
+    try:
+        summaries = await asyncio.gather(
+            *[_one_call(client, cheap_config, m, semaphore) for m in batch_messages]
+        )
+        repo_map = "\n## Repo map (files not shown in full)\n" + "\n".join(summaries) + "\n"
+    except Exception:
+        # Fall back to a bare path listing rather than failing the analysis
+        repo_map = "\n## Repo map (files not shown in full)\n" + \
+                   "\n".join(leftovers) + "\n"
+
+    # Keep the map within the headroom pack_chunks reserved for it,
+    # measured with the main model's tokenizer
+    main_enc = get_encoding(config)
+    map_tokens = main_enc.encode(repo_map)
+    if len(map_tokens) > REPO_MAP_TOKENS:
+        repo_map = main_enc.decode(map_tokens[:REPO_MAP_TOKENS - 10]) + "\n... [truncated]\n"
+    return repo_map
+
+
+async def _analyze_chunks(client, config: Dict[str, Any],
+                          query: str, chunks: List[Dict[str, str]],
+                          leftovers: Optional[Dict[str, str]] = None) -> str:
+    """Analyze each chunk concurrently, then consolidate the partial answers."""
+    # Exact-hash cache: same model, files, and query -> answer for free
+    context_hash, exact_hash = _cache_hashes(
+        config, query, chunks + ([leftovers] if leftovers else []))
+    cached = _cache_get(exact_hash)
+    if cached is not None:
+        print(cached)
+        return cached
+
+    # Semantic cache: a close-enough rephrasing of a past query over the
+    # same files reuses its answer
+    embedding = None
+    if np is not None:
+        embeddings = await _embed_texts(client, config, [query])
+        embedding = embeddings[0] if embeddings else None
+        if embedding is not None:
+            cached = _semantic_lookup(context_hash, embedding)
+            if cached is not None:
+                print(cached)
+                return cached
+
+    semaphore = asyncio.Semaphore(max(1, config.get("max_concurrency", 8)))
+
+    # Files beyond the chunk cap still reach the model as one-line summaries
+    repo_map = ""
+    if leftovers:
+        repo_map = await _summarize_leftovers(client, config, leftovers, semaphore)
+
+    chunk_messages = build_chunk_messages(config, query, chunks, repo_map)
+
+    # A single chunk needs no fan-out; stream it directly
+    if len(chunk_messages) == 1:
+        answer = await _stream_call(client, config, chunk_messages[0])
+        _cache_put(exact_hash, context_hash, query, embedding, answer)
+        return answer
+
+    partial_answers = await asyncio.gather(
+        *[_one_call(client, config, m, semaphore) for m in chunk_messages]
+    )
+
+    # Reduce the per-chunk answers with a final consolidation call
+    parts = [f"Query: {query}\n\n"
+             "The codebase was analyzed in parts. Combine the partial "
+             "answers below into one coherent answer to the query.\n"]
+    parts.extend(f"\n--- Partial answer {i + 1} ---\n{answer}\n"
+                 for i, answer in enumerate(partial_answers))
+
+    answer = await _stream_call(client, config, [
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {"role": "user", "content": "".join(parts)}
+    ])
+    _cache_put(exact_hash, context_hash, query, embedding, answer)
+    return answer
+
+
+async def _submit_batch(client, config: Dict[str, Any], query: str,
+                        chunks: List[Dict[str, str]]) -> str:
+    """Submit the chunk requests to the Batch API and return the batch id."""
+    lines = []
+    for i, messages in enumerate(build_chunk_messages(config, query, chunks)):
+        lines.append(json.dumps({
+            "custom_id": f"chunk-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": config["model"],
+                "messages": messages,
+                "temperature": config["temperature"],
+                "max_tokens": config["max_tokens"],
+            },
+        }))
+
+    batch_file = await client.files.create(
+        file=("phi_helper_batch.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+
+async def _fetch_batch_results(client, batch_id: str) -> Optional[str]:
+    """Fetch a batch's results, or None if it is still running."""
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        print(f"Batch {batch_id} is {batch.status}, try again later")
+        return None
+
+    output = await client.files.content(batch.output_file_id)
+    results = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        index = int(entry["custom_id"].rsplit("-", 1)[1])
+        results[index] = entry["response"]["body"]["choices"][0]["message"]["content"]
+
+    # Stitch the per-chunk answers back together in submission order
+    return "\n\n".join(results[i] for i in sorted(results))
+
+
+def analyze_code(client, config: Dict[str, Any], files: List[str], query: str,
+                 compress: bool = False):
+    """Analyze code files based on query."""
+    config = route_config(config, query)
+    chunks, leftovers = pack_chunks(config, files, query, compress=compress)
+    if not chunks:
+        print("Error: no readable files fit in the context window")
+        sys.exit(1)
+
+    # Call OpenAI API, streaming the (final) answer to stdout; failures
+    # must be loud, since callers discard the return on the success path
+    try:
+        return asyncio.run(_analyze_chunks(client, config, query, chunks, leftovers))
     except Exception as e:
-        return f"Error calling API: {str(e)}"
+        print(f"Error calling API: {str(e)}")
+        sys.exit(1)
 
 
 def command_setup(args):
@@ -234,7 +884,8 @@ def command_setup(args):
     # Save config
     with open(CONFIG_PATH, "w") as f:
         json.dump(config, f, indent=2)
-    
+    load_config.cache_clear()
+
     print(f"Configuration saved to {CONFIG_PATH}")
 
 
@@ -253,9 +904,8 @@ def command_analyze(args):
             files = [f for f in files if args.filter in f]
     
     print(f"Analyzing {len(files)} files with query: {args.query}")
-    result = analyze_code(client, config, files, args.query)
     print("\n--- RESULT ---\n")
-    print(result)
+    analyze_code(client, config, files, args.query, compress=args.compress)
 
 
 def command_docs(args):
@@ -264,28 +914,55 @@ def command_docs(args):
     client = setup_client(config)
     
     repo_path = args.repo_path or config["repository_path"] or os.getcwd()
-    
+
+    if args.batch_status:
+        result = asyncio.run(_fetch_batch_results(client, args.batch_status))
+        if result is None:
+            sys.exit(1)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(result)
+            print(f"Documentation written to {args.output}")
+        else:
+            print("\n--- DOCUMENTATION ---\n")
+            print(result)
+        return
+
     if not args.files:
         print("Error: Please specify at least one file to document")
         sys.exit(1)
-    
+
     query = "Generate comprehensive documentation for these files. Include:\n" + \
             "1. Overall purpose of each module/file\n" + \
             "2. Main functions and their behavior\n" + \
             "3. Data structures and their fields\n" + \
             "4. Any important patterns or design decisions\n" + \
             "Format as Markdown."
-    
+
+    if args.batch:
+        # Non-interactive: submit to the Batch API (~50% cheaper) and return
+        config = route_config(config, query)
+        chunks, leftovers = pack_chunks(config, args.files, query, compress=True)
+        if not chunks:
+            print("Error: no readable files fit in the context window")
+            sys.exit(1)
+        if leftovers:
+            print(f"Warning: {len(leftovers)} files beyond max_chunks were left out of the batch")
+        batch_id = asyncio.run(_submit_batch(client, config, query, chunks))
+        print(f"Submitted batch {batch_id}")
+        print(f"Fetch results with: phi_helper docs --batch-status {batch_id}" +
+              (f" --output {args.output}" if args.output else ""))
+        return
+
     print(f"Generating documentation for {len(args.files)} files")
-    result = analyze_code(client, config, args.files, query)
-    
+    print("\n--- DOCUMENTATION ---\n")
+    # Comments add little for docs generation; compress by default
+    result = analyze_code(client, config, args.files, query, compress=True)
+
     if args.output:
         with open(args.output, "w") as f:
             f.write(result)
         print(f"Documentation written to {args.output}")
-    else:
-        print("\n--- DOCUMENTATION ---\n")
-        print(result)
 
 
 def command_suggest(args):
@@ -305,9 +982,8 @@ def command_suggest(args):
             "Provide specific code examples where possible."
     
     print(f"Analyzing {len(args.files)} files for suggestions")
-    result = analyze_code(client, config, args.files, query)
     print("\n--- SUGGESTIONS ---\n")
-    print(result)
+    analyze_code(client, config, args.files, query)
 
 
 def main():
@@ -324,12 +1000,18 @@ def main():
     parser_analyze.add_argument("--files", nargs="*", help="Specific files to analyze")
     parser_analyze.add_argument("--filter", help="Filter files containing this string")
     parser_analyze.add_argument("--repo-path", help="Repository path")
+    parser_analyze.add_argument("--compress", action="store_true",
+                                help="Strip comments/docstrings from included source to save tokens")
     
     # Docs command
     parser_docs = subparsers.add_parser("docs", help="Generate documentation")
     parser_docs.add_argument("--files", nargs="*", help="Files to document")
     parser_docs.add_argument("--output", help="Output file for documentation")
     parser_docs.add_argument("--repo-path", help="Repository path")
+    parser_docs.add_argument("--batch", action="store_true",
+                             help="Submit via the Batch API (cheaper, completes within 24h)")
+    parser_docs.add_argument("--batch-status", metavar="ID",
+                             help="Fetch results of a previously submitted batch")
     
     # Suggest command
     parser_suggest = subparsers.add_parser("suggest", help="Suggest code improvements")